@@ -1,133 +1,182 @@
-#!/usr/bin/evn python
+#!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
 from celery import Celery
 import download
 from DownLoadStreetMapToolConfig import *
-import Tkinter
+import tkinter
 import time
-import tkFileDialog
+from tkinter import filedialog
 import globalmaptiles
+import tileindex
+import tilepack
 import os
-from Tkinter import StringVar
-import urllib
-import  urllib2
-import thread
+from tkinter import StringVar
+import threading
+import queue
 import sys
-import random
-reload(sys)
-sys.setdefaultencoding("utf-8")
+import itertools
+import multiprocessing
+import numpy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 app = Celery('download', broker='redis://172.18.18.47:6379/0')
-class GUI(Tkinter.Frame):
-    def __init__(self, root):
-        Tkinter.Frame.__init__(self, root)
+#download_batch通过download.app发布，broker连接池(默认10个)要容纳所有发布线程
+download.app.conf.broker_pool_limit = PUBLISH_THREADS
+#界面刷新间隔(毫秒)
+DRAIN_INTERVAL = 100
+
+def mkdir(path):
+    '''''创建目录，目录已存在时返回False，省去一次exists判断'''
+    try:
+        os.mkdir(path)
+        return True
+    except FileExistsError:
+        return False
+
+def fetch(tile):
+    '''''线程池中下载单个瓦片，返回(索引行, 错误信息)，失败时不抛出，避免中断整个下载'''
+    try:
+        return download.save_tile(tile), None
+    except Exception as e:
+        return None, '下载失败:%s %s' % (tile[1], e)
+
+def fetch_many(tiles):
+    '''''在线程/进程池中下载一组瓦片，返回每个瓦片的(索引行, 错误信息)'''
+    return [fetch(tile) for tile in tiles]
+
+def chunks(iterable, n):
+    '''''把iterable按每n个切成列表，只读取当前一块'''
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+class GUI(tkinter.Frame):
+    def __init__(self, root, distributed=DISTRIBUTED):
+        tkinter.Frame.__init__(self, root)
+        #True时通过Celery分发到远程worker，否则在本进程线程池下载
+        self.distributed = distributed
 
         #设置多行框架存放组件
-        self.frame = [Tkinter.Frame(padx=3, pady=3), Tkinter.Frame(padx=3, pady=3), Tkinter.Frame(padx=3, pady=3), Tkinter.Frame(padx=3, pady=3)]
+        self.frame = [tkinter.Frame(padx=3, pady=3), tkinter.Frame(padx=3, pady=3), tkinter.Frame(padx=3, pady=3), tkinter.Frame(padx=3, pady=3)]
 
         #第一行控件
-        Tkinter.Label(self.frame[0], text='左上角经纬度：经').pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[0], text='左上角经纬度：经').pack(side=tkinter.LEFT)
 
         ltlo = StringVar()
         ltlo.set('109')#73.666667
-        self.leftTopLon = Tkinter.Entry(self.frame[0], textvariable=ltlo)
-        self.leftTopLon.pack(side=Tkinter.LEFT)
+        self.leftTopLon = tkinter.Entry(self.frame[0], textvariable=ltlo)
+        self.leftTopLon.pack(side=tkinter.LEFT)
 
-        Tkinter.Label(self.frame[0], text='维').pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[0], text='维').pack(side=tkinter.LEFT)
 
         ltla = StringVar()
         ltla.set('26')#53.550000
-        self.leftTopLat = Tkinter.Entry(self.frame[0], textvariable=ltla)
-        self.leftTopLat.pack(side=Tkinter.LEFT)
+        self.leftTopLat = tkinter.Entry(self.frame[0], textvariable=ltla)
+        self.leftTopLat.pack(side=tkinter.LEFT)
 
-        Tkinter.Label(self.frame[0], text='右下角经纬度：经').pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[0], text='右下角经纬度：经').pack(side=tkinter.LEFT)
 
         rblo = StringVar()
         rblo.set('118')#135.041667
-        self.rightBottomLon = Tkinter.Entry(self.frame[0], textvariable=rblo)
-        self.rightBottomLon.pack(side=Tkinter.LEFT)
+        self.rightBottomLon = tkinter.Entry(self.frame[0], textvariable=rblo)
+        self.rightBottomLon.pack(side=tkinter.LEFT)
 
-        Tkinter.Label(self.frame[0], text='维').pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[0], text='维').pack(side=tkinter.LEFT)
 
         rbla = StringVar()
         rbla.set('20')#3.866667
-        self.rightBottomLat = Tkinter.Entry(self.frame[0], textvariable=rbla)
-        self.rightBottomLat.pack(side=Tkinter.LEFT)
+        self.rightBottomLat = tkinter.Entry(self.frame[0], textvariable=rbla)
+        self.rightBottomLat.pack(side=tkinter.LEFT)
 
-        self.frame[0].pack(expand=0, fill=Tkinter.X)
-        Tkinter.Label(self.frame[0], text='线程').pack(side=Tkinter.LEFT)
+        self.frame[0].pack(expand=0, fill=tkinter.X)
+        tkinter.Label(self.frame[0], text='线程').pack(side=tkinter.LEFT)
         threadNum = StringVar()
         threadNum.set('20')#3.866667
-        self.threadNumC = Tkinter.Entry(self.frame[0], textvariable=threadNum)
-        self.threadNumC.pack(side=Tkinter.LEFT)
+        self.threadNumC = tkinter.Entry(self.frame[0], textvariable=threadNum)
+        self.threadNumC.pack(side=tkinter.LEFT)
         #第二行控件
-        #Tkinter.Label(self.frame[1], text='选择下载地图的服务器').pack(side=Tkinter.LEFT)
+        #tkinter.Label(self.frame[1], text='选择下载地图的服务器').pack(side=tkinter.LEFT)
 
-       # self.ss = Tkinter.StringVar()
+       # self.ss = tkinter.StringVar()
         #self.ss.set(mapServers[0])
-        #Tkinter.OptionMenu(self.frame[1], self.ss, *mapServers).pack(side=Tkinter.LEFT)
+        #tkinter.OptionMenu(self.frame[1], self.ss, *mapServers).pack(side=tkinter.LEFT)
 
-        self.mapLevelStart = Tkinter.StringVar()
+        self.mapLevelStart = tkinter.StringVar()
         self.mapLevelStart.set(2)
-        self.mapLevelEnd = Tkinter.StringVar()
+        self.mapLevelEnd = tkinter.StringVar()
         self.mapLevelEnd.set(18)
 
-        Tkinter.Label(self.frame[1], text='地图下载起始级别').pack(side=Tkinter.LEFT)
-        Tkinter.OptionMenu(self.frame[1], self.mapLevelStart, *range(0, 20)).pack(side=Tkinter.LEFT)
-        Tkinter.Label(self.frame[1], text='地图下载终止级别').pack(side=Tkinter.LEFT)
-        Tkinter.OptionMenu(self.frame[1], self.mapLevelEnd, *range(0, 20)).pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[1], text='地图下载起始级别').pack(side=tkinter.LEFT)
+        tkinter.OptionMenu(self.frame[1], self.mapLevelStart, *range(0, 20)).pack(side=tkinter.LEFT)
+        tkinter.Label(self.frame[1], text='地图下载终止级别').pack(side=tkinter.LEFT)
+        tkinter.OptionMenu(self.frame[1], self.mapLevelEnd, *range(0, 20)).pack(side=tkinter.LEFT)
 
         #存放目录
-        self.btSaveFolder = Tkinter.Button(self.frame[1], text='选择存放目录', command=self.selectSaveFolder)
-        self.btSaveFolder.pack(side=Tkinter.LEFT)
+        self.btSaveFolder = tkinter.Button(self.frame[1], text='选择存放目录', command=self.selectSaveFolder)
+        self.btSaveFolder.pack(side=tkinter.LEFT)
 
-        self.btAction = Tkinter.Button(self.frame[1], text='开始下载', bg='red', fg='yellow', command=self.doDownload)
-        self.btAction.pack(side=Tkinter.RIGHT, expand=1, fill=Tkinter.X)
-        self.frame[1].pack(expand=0, fill=Tkinter.X)
+        self.btAction = tkinter.Button(self.frame[1], text='开始下载', bg='red', fg='yellow', command=self.doDownload)
+        self.btAction.pack(side=tkinter.RIGHT, expand=1, fill=tkinter.X)
+        self.frame[1].pack(expand=0, fill=tkinter.X)
 
         #第三行控件
 
         #文本框滚动条
-        self.sl = Tkinter.Scrollbar(self.frame[2])
+        self.sl = tkinter.Scrollbar(self.frame[2])
         self.sl.pack(side='right', fill='y')
         #显示结果的文本框
-        self.message = Tkinter.Text(self.frame[2], yscrollcommand=self.sl.set)
+        self.message = tkinter.Text(self.frame[2], yscrollcommand=self.sl.set)
         #将滚动条的值与文本框绑定，这样滚动条才有作用
         self.sl.config(command=self.message.yview)
-        self.message.pack(expand=1, fill=Tkinter.BOTH)
+        self.message.pack(expand=1, fill=tkinter.BOTH)
         self.message.bind("<KeyPress>", lambda e : "break")
 
-        self.frame[2].pack(expand=1, fill=Tkinter.BOTH)
+        self.frame[2].pack(expand=1, fill=tkinter.BOTH)
 
 
         #第四行控件
-        self.clAction = Tkinter.Button(self.frame[3], text='清空日志', command=self.clear)
-        self.clAction.pack(side=Tkinter.LEFT)
+        self.clAction = tkinter.Button(self.frame[3], text='清空日志', command=self.clear)
+        self.clAction.pack(side=tkinter.LEFT)
 
-        Tkinter.Label(self.frame[3], text='Status:').pack(side=Tkinter.LEFT)
-        self.lbcount = Tkinter.Label(self.frame[3], text='')
-        self.lbcount.pack(side=Tkinter.LEFT)
+        tkinter.Label(self.frame[3], text='Status:').pack(side=tkinter.LEFT)
+        self.lbcount = tkinter.Label(self.frame[3], text='')
+        self.lbcount.pack(side=tkinter.LEFT)
 
-        self.frame[3].pack(expand=0, fill=Tkinter.X)
+        self.frame[3].pack(expand=0, fill=tkinter.X)
 
         self.gm = globalmaptiles.GlobalMercator()
 
+        #tkinter不是线程安全的，后台线程只写队列和状态，由主线程定时刷新到界面
+        self.logq = queue.Queue()
+        #已完成的瓦片数(跳过的已下载瓦片、下载完成或已提交到Celery的瓦片)、总数及当前遍历到的瓦片(x, y, z)
+        self.count = self.total = 0
+        self.position = None
+        self.shownStatus = None
+        self.after(DRAIN_INTERVAL, self.drainLogs)
+
     def clear(self):
-        self.message.delete('1.0', Tkinter.END)
+        self.message.delete('1.0', tkinter.END)
 
     def LatLon2GoogleTile(self, lat, lon, zoom):
         '''''坐标转换为GoogleMap瓦片编号'''
-        mx, my = self.gm.LatLonToMeters(lat, lon)
-        tx, ty = self.gm.MetersToTile(mx, my, zoom)
-        return self.gm.GoogleTile(tx, ty, zoom)
+        return self.gm.LatLonToGoogleTile(lat, lon, zoom)
+
+    def LatLon2GoogleTilePyramid(self, lat, lon, zooms, zmax):
+        '''''只在最大级别zmax换算一次，低级别瓦片编号为高级别编号右移级别差'''
+        tx, ty = self.LatLon2GoogleTile(lat, lon, zmax)
+        shifts = zmax - zooms
+        return numpy.right_shift(tx, shifts), numpy.right_shift(ty, shifts)
 
     def selectSaveFolder(self):
-        self.dir = tkFileDialog.askdirectory(initialdir='/')
+        self.dir = filedialog.askdirectory(initialdir='/')
         self.log('选择存放目录：' + self.dir)
 
     def doDownload(self):
         #多线程处理长时间方法避免UI无响应
-        thread.start_new_thread(self.download, ())
+        threading.Thread(target=self.download, daemon=True).start()
 
     def download(self):
         ltlat = float(self.leftTopLat.get())
@@ -137,14 +186,14 @@ class GUI(Tkinter.Frame):
         ls = int(self.mapLevelStart.get())
         ln = int(self.mapLevelEnd.get())
 
-        total = 0
-        for i in range(ls, ln + 1):
-            #计算这个级别的地图编号
-            x, y = self.LatLon2GoogleTile(ltlat, ltlon, i)
-            xe, ye = self.LatLon2GoogleTile(rblat, rblon, i)
-            s = (xe - x + 1) * (ye - y + 1)
-            total += s
-            self.log('%s:%d x:%d y:%d ~ x:%d y:%d 瓦片数:%d' % ('下载地图级别', i, x, y, xe, ye, s))
+        #一次计算所有级别的地图编号，按级别索引
+        zooms = numpy.arange(ls, ln + 1, dtype=numpy.int64)
+        xs, ys = self.LatLon2GoogleTilePyramid(ltlat, ltlon, zooms, ln)
+        xes, yes = self.LatLon2GoogleTilePyramid(rblat, rblon, zooms, ln)
+        sizes = (xes - xs + 1) * (yes - ys + 1)
+        total = int(sizes.sum())
+        for n in range(len(zooms)):
+            self.log('%s:%d x:%d y:%d ~ x:%d y:%d 瓦片数:%d' % ('下载地图级别', zooms[n], xs[n], ys[n], xes[n], yes[n], sizes[n]))
         self.log('%s:%d' % ('下载瓦片数合计', total))
 
         #return True
@@ -153,58 +202,195 @@ class GUI(Tkinter.Frame):
         froot = self.dir + '/map'# + str(time.time())
         #下载失败路径
         self.log('创建目录:' + froot)
-        if os.path.exists(froot)==False:
-            os.mkdir(froot);
+        os.makedirs(froot, exist_ok=True)
+
+        #每个级别的(z, x, y, xe, ye)，按级别、列、行逐个生成瓦片，不预先分配全部瓦片
+        ranges = list(zip(zooms.tolist(), xs.tolist(), ys.tolist(), xes.tolist(), yes.tolist()))
+        self.count, self.total = 0, total
+        tiles = self.tiles(froot, ranges)
+        if self.distributed:
+            self.dispatch(tiles)
+        else:
+            self.fetchLocal(tiles, int(self.threadNumC.get()))
+
+        self.log('下载完成！')
+
+    def tiles(self, froot, ranges):
+        '''''遍历每个级别(z, x, y, xe, ye)中的瓦片，生成尚未下载的(file_name, url)，打包模式为(pack_file, url, offset, slot)
 
-        #已经下载计数
-        count = 0
+        跳过的瓦片在这里计入self.count，生成的瓦片由调用方在完成后计数'''
+        index = tileindex.get(froot)
 
-        #遍历层
-        for i in range(ls, ln + 1):
+        for i, x0, y0, xe0, ye0 in ranges:
             #创建层目录
             flev = froot + '/' + str(i)
-            if os.path.exists(flev)==False:
-                os.mkdir(flev)
+            mkdir(flev)
             self.log('创建层级目录:' + flev)
-
-            x, y = self.LatLon2GoogleTile(ltlat, ltlon, i)
-            xe, ye = self.LatLon2GoogleTile(rblat, rblon, i)
-
-            #遍历x
-            for j in range(x, xe + 1):
-                fx = flev + '/' + str(j)
-                if os.path.exists(fx)==False:
-                    os.mkdir(fx)
-                self.log('创建X方向目录:' + fx)
-                for k in range(y, ye + 1):
-                    #下载地址
-                    #url = DOWNURL % (self.ss.get(), j, k, i)
-                    #判断是否存在
-                    file_name= fx + '/' + str(k) + '.png'
-                    if os.path.exists(file_name):
-                        time.sleep(0.001)
+            #级别在本层内不变，预先代入DOWNURL中的第一个%d，最后一个%d(y)之前的部分按列生成前缀
+            url_head, url_tail = DOWNURL.replace('%d', str(i), 1).rsplit('%d', 1)
+            #本层每一列的y范围相同，y相关的字符串只生成一次
+            count = ye0 - y0 + 1
+            tile_names = [str(k) + '.png' for k in range(y0, ye0 + 1)]
+            url_names = [str(k) + url_tail for k in range(y0, ye0 + 1)]
+            for j in range(x0, xe0 + 1):
+                #子域名按(x + y)轮换，y对子域名个数取余即可选出本列的前缀
+                url_prefs = [url_head % (SUBDOMAINS[(j + n) % len(SUBDOMAINS)], j) for n in range(len(SUBDOMAINS))]
+                if PACK:
+                    fx = tilepack.pack_name(flev, j)
+                    try:
+                        if tilepack.create(fx, y0, count, PACK_SLOT):
+                            existing = set()
+                        else:
+                            existing = tilepack.done(fx, count, PACK_SLOT)
+                    except (ValueError, OSError) as e:
+                        #已有打包文件的范围不同或无法创建(如磁盘已满)，跳过该列
+                        self.log('打包文件无法使用:%s' % e)
+                        existing = set(range(count))
+                    self.log('创建打包文件:' + fx)
+                else:
+                    fx = flev + '/' + str(j)
+                    fx_pref = fx + '/'
+                    #一次读取该列已下载的瓦片，代替逐个瓦片exists
+                    existing = set() if mkdir(fx) else self.scanColumn(index, fx, i, j)
+                    self.log('创建X方向目录:' + fx)
+                for n in range(count):
+                    k = y0 + n
+                    #已存在的瓦片直接跳过
+                    if PACK:
+                        skip = n in existing
                     else:
-                        url = DOWNURL % (random.choice('abc'), i,j, k)
-                        self.log("url:"+url)
-                        download.download.delay(file_name,url)
-                    count += 1
-                    self.lbcount['text'] = '已完成:%d/%d 瓦片编号 x:%d y:%d z:%d' % (count, total, j, k, i)
-
-        self.log('下载完成！')
-        thread.exit_thread()
-
-
+                        skip = k in existing
+                    self.position = (j, k, i)
+                    if skip:
+                        self.count += 1
+                    else:
+                        #下载地址，子域名按瓦片编号轮换，同一子域名的连接保持复用
+                        #url = DOWNURL % (self.ss.get(), j, k, i)
+                        url = url_prefs[k % len(SUBDOMAINS)] + url_names[n]
+                        if PACK:
+                            yield fx, url, n * PACK_SLOT, PACK_SLOT
+                        else:
+                            yield fx_pref + tile_names[n], url
+
+    def scanColumn(self, index, fx, z, x):
+        '''''返回一列中已完整下载的y：文件大小与索引一致，或不在索引中的非空文件
+
+        不在索引中的文件来自旧版本或远程worker，下载时先写.part再改名，按文件大小补入索引；
+        大小不一致的记录删除，远程worker重新下载后下次扫描时补建'''
+        indexed = index.column(z, x)
+        result = set()
+        rows = []
+        stale = []
+        for e in os.scandir(fx):
+            name, ext = os.path.splitext(e.name)
+            if ext != '.png' or not name.isdigit():
+                continue
+            y = int(name)
+            size = e.stat().st_size
+            if y in indexed:
+                if indexed[y] == size:
+                    result.add(y)
+                else:
+                    stale.append(y)
+            elif size:
+                result.add(y)
+                rows.append((z, x, y, size, None))
+        if rows:
+            index.record(rows)
+        if stale:
+            index.forget(z, x, stale)
+        return result
+
+    def dispatch(self, tiles):
+        '''''批量提交下载任务到Celery，每DISPATCH_CHUNK个瓦片合并为一个download_batch任务
+
+        多个线程同时发布消息，各自从download.app的producer池取得broker连接'''
+        with ThreadPoolExecutor(PUBLISH_THREADS) as ex:
+            inflight = set()
+
+            def publish(batch):
+                #限制未发布的批次数，避免遍历比发布快时所有瓦片都堆在内存中
+                if len(inflight) >= 2 * PUBLISH_THREADS:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    inflight.difference_update(done)
+                    for future in done:
+                        #发布失败时抛出，与串行提交时一致
+                        future.result()
+                inflight.add(ex.submit(download.download_batch.delay, batch))
+                self.count += len(batch)
+
+            for batch in chunks(tiles, DISPATCH_CHUNK):
+                publish(batch)
+            for future in inflight:
+                future.result()
+
+    def fetchLocal(self, tiles, workers):
+        '''''不经过Celery在本机下载，LOCAL_POOL为thread时线程共用download模块的keep-alive会话，
+        为process时每个进程各自建立会话
+
+        同时最多有2 * workers块瓦片在池中，遍历不会跑在下载前面把所有瓦片堆在内存中'''
+        if LOCAL_POOL == 'process':
+            #GUI进程中有多个线程，fork出的子进程可能继承被占用的锁，子进程用spawn启动，各自导入download模块建立会话
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            chunksize = LOCAL_CHUNKSIZE
+        else:
+            #所有线程共用一个会话，连接池按线程数建立，多出的keep-alive连接不会被丢弃
+            download.size_session(workers)
+            executor = ThreadPoolExecutor(workers)
+            chunksize = 1
+        rows = []
+
+        def collect(done):
+            for future in done:
+                for row, error in future.result():
+                    self.count += 1
+                    if error:
+                        self.log(error)
+                    #打包模式的瓦片不写索引
+                    if row:
+                        rows.append(row)
+            if len(rows) >= tileindex.BATCH:
+                tileindex.record_files(rows)
+                del rows[:]
+
+        with executor:
+            inflight = set()
+            for chunk in chunks(tiles, chunksize):
+                if len(inflight) >= 2 * workers:
+                    done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                inflight.add(executor.submit(fetch_many, chunk))
+            collect(wait(inflight)[0])
+        tileindex.record_files(rows)
 
     def downloadCallback(self, a, b, c):
         '''''a,已下载的数据块  b,数据块的大小  c,远程文件的大小'''
         pass
 
     def log(self, msg):
-        self.message.insert(Tkinter.END, time.strftime('%Y-%m-%d %H:%M:%S\t', time.localtime(time.time())) + msg + '\n')
+        self.logq.put(time.strftime('%Y-%m-%d %H:%M:%S\t', time.localtime(time.time())) + msg + '\n')
+
+    def drainLogs(self):
+        '''''在主线程中把积压的日志全部取出合并为一次insert，并刷新状态栏
+
+        日志只有目录、级别和失败信息，每个瓦片的进度只体现在状态栏中'''
+        lines = []
+        try:
+            while True:
+                lines.append(self.logq.get_nowait())
+        except queue.Empty:
+            pass
+        if lines:
+            self.message.insert(tkinter.END, ''.join(lines))
+        status = (self.count, self.total, self.position)
+        if self.position is not None and status != self.shownStatus:
+            self.shownStatus = status
+            self.lbcount.config(text='已完成:%d/%d 瓦片编号 x:%d y:%d z:%d' % ((self.count, self.total) + self.position))
+        self.after(DRAIN_INTERVAL, self.drainLogs)
 
 if __name__ == '__main__':
-    root = Tkinter.Tk()
-    GUI(root).pack()
+    root = tkinter.Tk()
+    GUI(root, distributed=DISTRIBUTED or '--distributed' in sys.argv).pack()
     root.title(TITLE)
     root.minsize(WIDTH, HEIGHT)
     #root.maxsize(WIDTH, HEIGHT)
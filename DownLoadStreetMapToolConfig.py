@@ -1,4 +1,4 @@
-#!/usr/bin/evn python
+#!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
 #下载服务器mt0~mt3
@@ -8,14 +8,35 @@
 #卫星地图
 #http://mt0.google.cn/vt/lyrs=s@118&hl=zh-CN&gl=cn&src=app&x=104&y=52&z=7&s=Gali
 
-#下载模板 需要传入4个参数使用
+#下载模板 需要传入4个参数使用，依次为子域名、级别、x、y（级别必须是第一个%d）
 #DOWNURL='http://%s/vt/lyrs=m@187000000&hl=zh-CN&gl=cn&src=app&x=%d&y=%d&z=%d&s=Galil'
 DOWNURL='http://%s.tile.thunderforest.com/transport/%d/%d/%d.png'
+#DOWNURL中%s可用的子域名
+SUBDOMAINS = 'abc'
 #DOWNURL='http://otile3.mqcdn.com/tiles/1.0.0/osm/%d/%d/%d.png'
 TITLE = 'OpenStreetMap 瓦片下载工具 v1.0'
 WIDTH = 900
 HEIGHT = 600
 
+#是否通过Celery分发到远程worker下载，命令行--distributed等同于True
+#远程worker与GUI需共享下载目录
+DISTRIBUTED = False
+
+#不使用Celery时的本机下载方式：thread为线程池，process为进程池
+LOCAL_POOL = 'thread'
+#进程池每次交给一个进程的瓦片数，分摊进程间传输的开销；线程池每次只交给一个线程一个瓦片
+LOCAL_CHUNKSIZE = 256
+
+#每条broker消息打包的下载任务数
+DISPATCH_CHUNK = 500
+#同时向broker发布任务的线程数
+PUBLISH_THREADS = 32
+
+#打包模式：每列瓦片写入一个xcol_{x}.bin，见tilepack.py
+PACK = False
+#打包文件中每个瓦片占用的字节数(含4字节长度头)，按实际瓦片大小设置，超过slot的瓦片作为下载失败记录
+PACK_SLOT = 32768
+
 #图片大小
 #IMGSIZE = 256
 
@@ -1,16 +1,138 @@
 #-*-coding:utf-8-*-
 #download.py
+#worker使用gevent池启动，一个进程可同时下载数百个瓦片：
+#  celery -A download worker -P gevent -c 200
+#或直接运行python download.py
 
+if __name__ == '__main__':
+    #补丁必须在导入socket/requests之前打上；celery -P gevent启动时由celery自动完成，
+    #被GUI导入时不打补丁
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
 from celery import Celery
-import  urllib2
+from celery.utils.log import get_task_logger
+from celery.signals import worker_init
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+import tilepack
 
 app = Celery('download', broker='redis://172.18.18.47:6379/0')
+logger = get_task_logger(__name__)
+
+def gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+#是否运行在gevent池的worker中
+GEVENT = gevent_patched()
+#直接运行python download.py时gevent池worker的并发任务数，celery命令启动时以-c为准
+WORKER_CONCURRENCY = 200
+
+#HTTP/1.0服务器需要显式声明keep-alive
+HEADERS = {'Connection': 'keep-alive'}
+TIMEOUT = 10
+#Windows下需要O_BINARY，否则会转换换行符
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+#非gevent池时download_batch在一个任务内同时下载的瓦片数
+BATCH_CONCURRENCY = 32
+
+def new_session(pool_maxsize=BATCH_CONCURRENCY):
+    '''''创建复用TCP连接的会话，同一worker的瓦片请求共用连接池'''
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    #连接池按主机划分，瓦片服务器的每个子域名各自保持keep-alive连接
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_session = new_session()
+
+def size_session(maxsize):
+    '''''按同时进行的请求数重建会话，必须在开始下载之前调用'''
+    global _session
+    _session = new_session(maxsize)
+
+@worker_init.connect
+def on_worker_init(sender, **kwargs):
+    '''''gevent池中所有并发任务共用一个会话，连接池按worker实际的并发任务数(-c)建立'''
+    if GEVENT:
+        size_session(sender.concurrency)
+
+def fetch(url):
+    #服务器关闭的空闲连接由urllib3丢弃，连接失败由adapter的max_retries重试
+    r = _session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r
+
+def write_file(file_name, data):
+    '''''不经过文件对象的缓冲层，直接用文件描述符写入整个瓦片
 
+    先写入.part文件再改名，下载中断不会在瓦片文件名下留下残缺的文件'''
+    part = file_name + '.part'
+    fd = os.open(part, WRITE_FLAGS, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(part, file_name)
+
+def save(file_name, url):
+    '''''下载并写入瓦片，返回(size, etag)供写入索引'''
+    r = fetch(url)
+    respHtml = r.content
+    write_file(file_name, respHtml)
+    return len(respHtml), r.headers.get('ETag')
+
+def save_tile(tile):
+    '''''tile为(file_name, url)或打包模式的(pack_file, url, offset, slot)
+
+    返回散文件的索引行(file_name, size, etag)；打包文件自带长度头，不写索引，返回None'''
+    if len(tile) == 4:
+        pack_file, url, offset, slot = tile
+        tilepack.write(pack_file, offset, slot, fetch(url).content)
+        return None
+    file_name, url = tile
+    size, etag = save(file_name, url)
+    return file_name, size, etag
+
+def save_tuple(tile):
+    '''''下载单个瓦片，返回(索引行, 失败的url)，失败时不抛出'''
+    try:
+        return save_tile(tile), None
+    except Exception as e:
+        logger.warning('download failed: %s %s', tile[1], e)
+        return None, tile[1]
+
+_pool = None
+
+#worker只写瓦片文件，不写索引：索引由GUI在扫描每一列时按文件大小补建，
+#其他主机上的worker通过共享目录下载时不会经网络文件系统写SQLite
 @app.task
 def download(file_name,url):
-     req = urllib2.Request(url);
-     resp = urllib2.urlopen(req);
-     respHtml = resp.read();
-     binfile = open(file_name, "wb");
-     binfile.write(respHtml);
-     binfile.close();
+    save(file_name, url)
+
+@app.task
+def download_batch(tiles):
+    '''''一个任务下载一批瓦片，网络等待与写盘在worker内部重叠，返回失败的url'''
+    global _pool
+    if GEVENT:
+        #gevent池已有-c个任务同时运行，任务内逐个下载，同时进行的请求数不超过-c
+        results = map(save_tuple, tiles)
+    else:
+        if _pool is None:
+            #在worker子进程中首次使用时再创建线程
+            _pool = ThreadPool(BATCH_CONCURRENCY)
+        results = _pool.imap_unordered(save_tuple, tiles)
+    return [url for row, url in results if url]
+
+if __name__ == '__main__':
+    app.worker_main(['worker', '-P', 'gevent', '-c', str(WORKER_CONCURRENCY)])
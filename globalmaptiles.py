@@ -63,6 +63,34 @@ globalmaptiles.py
 """
 import math
 
+# base-4 strings of every byte, a byte holds 4 quadkey digits
+_BASE4 = [''.join(str((b >> s) & 3) for s in (6, 4, 2, 0)) for b in range(256)]
+
+def _spread_bits(v):
+    "Spreads the low 32 bits of v to the even bit positions (SWAR)"
+
+    v &= 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+def _interleave_bits(x, y):
+    "Morton (Z-order) code, bit i of x goes to bit 2i and bit i of y to bit 2i+1"
+
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+def _base4_str(m, digits):
+    "Base-4 representation of m padded to the given number of digits"
+
+    nbytes = (digits + 3) // 4
+    s = ''.join([_BASE4[(m >> (8 * b)) & 0xFF] for b in range(nbytes - 1, -1, -1)])
+    return s[len(s) - digits:]
+
+MAXZOOMLEVEL = 32
+
 class GlobalMercator(object):
     """
 70.    TMS Global Mercator Profile
@@ -167,6 +195,11 @@ class GlobalMercator(object):
         # 156543.03392804062 for tileSize 256 pixels
         self.originShift = 2 * math.pi * 6378137 / 2.0
         # 20037508.342789244
+        # resolution lookup table for zoom levels 0..MAXZOOMLEVEL-1,
+        # Resolution() computes other zoom levels directly
+        self._res = [self.initialResolution / 2**z for z in range(MAXZOOMLEVEL)]
+        # number of tiles per axis for the same zoom levels
+        self._pow2 = [1 << z for z in range(MAXZOOMLEVEL)]
 
     def LatLonToMeters(self, lat, lon ):
         "Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913"
@@ -221,6 +254,18 @@ class GlobalMercator(object):
         px, py = self.MetersToPixels( mx, my, zoom)
         return self.PixelsToTile( px, py)
 
+    def LatLonToGoogleTile(self, lat, lon, zoom):
+        "Converts given lat/lon in WGS84 Datum directly to Google Tile coordinates"
+
+        # LatLonToMeters -> MetersToPixels -> PixelsToTile -> GoogleTile in one pass
+        res = self._res[zoom] if 0 <= zoom < MAXZOOMLEVEL else self.initialResolution / (2**zoom)
+        px = (lon * self.originShift / 180.0 + self.originShift) / res
+        my = math.log( math.tan((90 + lat) * math.pi / 360.0 )) * (self.originShift / math.pi)
+        py = (my + self.originShift) / res
+        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
+        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
+        return tx, ((self._pow2[zoom] if 0 <= zoom < MAXZOOMLEVEL else 2**zoom) - 1) - ty
+
     def TileBounds(self, tx, ty, zoom):
         "Returns bounds of the given tile in EPSG:900913 coordinates"
 
@@ -241,6 +286,8 @@ class GlobalMercator(object):
         "Resolution (meters/pixel) for given zoom level (measured at Equator)"
 
         # return (2 * math.pi * 6378137) / (self.tileSize * 2**zoom)
+        if 0 <= zoom < MAXZOOMLEVEL:
+            return self._res[zoom]
         return self.initialResolution / (2**zoom)
 
     def ZoomForPixelSize(self, pixelSize ):
@@ -254,13 +301,13 @@ class GlobalMercator(object):
         "Converts TMS tile coordinates to Google Tile coordinates"
 
         # coordinate origin is moved from bottom-left to top-left corner of the extent
-        return tx, (2**zoom - 1) - ty
+        return tx, ((self._pow2[zoom] if 0 <= zoom < MAXZOOMLEVEL else 2**zoom) - 1) - ty
 
     def QuadTree(self, tx, ty, zoom ):
         "Converts TMS tile coordinates to Microsoft QuadTree"
 
         quadKey = ""
-        ty = (2**zoom - 1) - ty
+        ty = ((self._pow2[zoom] if 0 <= zoom < MAXZOOMLEVEL else 2**zoom) - 1) - ty
         for i in range(zoom, 0, -1):
             digit = 0
             mask = 1 << (i-1)
@@ -272,6 +319,16 @@ class GlobalMercator(object):
 
         return quadKey
 
+    def QuadTreeFast(self, tx, ty, zoom ):
+        "Converts TMS tile coordinates to Microsoft QuadTree without a per-level loop"
+
+        # every quadkey digit is one (x bit, y bit) pair of the Morton code
+        if zoom > 32:
+            # the Morton code covers 32 bits of tx and ty
+            return self.QuadTree(tx, ty, zoom)
+        ty = ((self._pow2[zoom] if 0 <= zoom < MAXZOOMLEVEL else 2**zoom) - 1) - ty
+        return _base4_str(_interleave_bits(tx, ty), zoom)
+
 #---------------------
 
 class GlobalGeodetic(object):
@@ -347,15 +404,15 @@ if __name__ == "__main__":
     import sys, os
 
     def Usage(s = ""):
-        print "Usage: globalmaptiles.py [-profile 'mercator'|'geodetic'] zoomlevel lat lon [latmax lonmax]"
-        print
+        print("Usage: globalmaptiles.py [-profile 'mercator'|'geodetic'] zoomlevel lat lon [latmax lonmax]")
+        print()
         if s:
-            print s
-            print
-        print "This utility prints for given WGS84 lat/lon coordinates (or bounding box) the list of tiles"
-        print "covering specified area. Tiles are in the given 'profile' (default is Google Maps 'mercator')"
-        print "and in the given pyramid 'zoomlevel'."
-        print "For each tile several information is printed including bonding box in EPSG:900913 and WGS84."
+            print(s)
+            print()
+        print("This utility prints for given WGS84 lat/lon coordinates (or bounding box) the list of tiles")
+        print("covering specified area. Tiles are in the given 'profile' (default is Google Maps 'mercator')")
+        print("and in the given pyramid 'zoomlevel'.")
+        print("For each tile several information is printed including bonding box in EPSG:900913 and WGS84.")
         sys.exit(1)
 
     profile = 'mercator'
@@ -406,14 +463,14 @@ if __name__ == "__main__":
     mercator = GlobalMercator()
 
     mx, my = mercator.LatLonToMeters( lat, lon )
-    print "Spherical Mercator (ESPG:900913) coordinates for lat/lon: "
-    print (mx, my)
+    print("Spherical Mercator (ESPG:900913) coordinates for lat/lon: ")
+    print((mx, my))
     tminx, tminy = mercator.MetersToTile( mx, my, tz )
 
     if boundingbox:
         mx, my = mercator.LatLonToMeters( latmax, lonmax )
-        print "Spherical Mercator (ESPG:900913) cooridnate for maxlat/maxlon: "
-        print (mx, my)
+        print("Spherical Mercator (ESPG:900913) cooridnate for maxlat/maxlon: ")
+        print((mx, my))
         tmaxx, tmaxy = mercator.MetersToTile( mx, my, tz )
     else:
         tmaxx, tmaxy = tminx, tminy
@@ -421,16 +478,16 @@ if __name__ == "__main__":
     for ty in range(tminy, tmaxy+1):
         for tx in range(tminx, tmaxx+1):
             tilefilename = "%s/%s/%s" % (tz, tx, ty)
-            print tilefilename, "( TileMapService: z / x / y )"
+            print(tilefilename, "( TileMapService: z / x / y )")
 
             gx, gy = mercator.GoogleTile(tx, ty, tz)
-            print "\tGoogle:", gx, gy
+            print("\tGoogle:", gx, gy)
             quadkey = mercator.QuadTree(tx, ty, tz)
-            print "\tQuadkey:", quadkey, '(',int(quadkey, 4),')'
+            print("\tQuadkey:", quadkey, '(',int(quadkey, 4),')')
             bounds = mercator.TileBounds( tx, ty, tz)
-            print "\tEPSG:900913 Extent: ", bounds
+            print("\tEPSG:900913 Extent: ", bounds)
             wgsbounds = mercator.TileLatLonBounds( tx, ty, tz)
-            print "\tWGS84 Extent:", wgsbounds
-            print "\tgdalwarp -ts 256 256 -te %s %s %s %s %s %s_%s_%s.tif" % (
-                bounds[0], bounds[1], bounds[2], bounds[3], "<your-raster-file-in-epsg900913.ext>", tz, tx, ty)
+            print("\tWGS84 Extent:", wgsbounds)
+            print("\tgdalwarp -ts 256 256 -te %s %s %s %s %s %s_%s_%s.tif" % (
+                bounds[0], bounds[1], bounds[2], bounds[3], "<your-raster-file-in-epsg900913.ext>", tz, tx, ty))
 
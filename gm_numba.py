@@ -0,0 +1,37 @@
+#-*-coding:utf-8-*-
+#gm_numba.py
+#GlobalMercator瓦片枚举的Numba批量版本，逐级别按块生成(z, x, y)，内存只占一个块
+#numba为可选依赖，未安装时用纯Python生成同样的块
+#供需要(z, x, y)数组的批量处理使用；GUI下载时每个瓦片还要逐级别、逐列处理，直接用range遍历更快，不使用本模块
+
+import numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def fill_tiles(z, x, y, h, start, out_xyz):
+        '''''把一个级别中第start个起的瓦片编号写入out_xyz，该级别每列有h个瓦片
+
+        内层循环只有整数运算，并行填充'''
+        for t in prange(out_xyz.shape[0]):
+            s = start + t
+            out_xyz[t, 0] = z
+            out_xyz[t, 1] = x + s // h
+            out_xyz[t, 2] = y + s % h
+
+def tile_blocks(zooms, xs, ys, xes, yes, block):
+    '''''按级别、x、y顺序生成各级别[x, xe] x [y, ye]的瓦片编号，每次最多block个[z, x, y]'''
+    for z, x, y, xe, ye in zip(*[numpy.asarray(a).tolist() for a in (zooms, xs, ys, xes, yes)]):
+        h = max(ye - y + 1, 0)
+        cnt = max(xe - x + 1, 0) * h
+        for start in range(0, cnt, block):
+            n = min(block, cnt - start)
+            if njit is None:
+                yield [[z, x + s // h, y + s % h] for s in range(start, start + n)]
+            else:
+                out_xyz = numpy.empty((n, 3), dtype=numpy.int64)
+                fill_tiles(z, x, y, h, start, out_xyz)
+                yield out_xyz.tolist()
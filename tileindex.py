@@ -0,0 +1,74 @@
+#-*-coding:utf-8-*-
+#tileindex.py
+#已下载瓦片的SQLite索引 (z, x, y) -> (size, etag, mtime)
+#只有完整写入磁盘的瓦片才会记录，下载中断留下的残缺文件不在索引中
+#索引只由GUI进程读写：本机下载时记录下载结果，扫描已有的列时为不在索引中的文件按大小补建，
+#Celery worker只写瓦片文件，可以在其他主机上通过共享目录下载
+
+import os
+import sqlite3
+import threading
+import time
+
+INDEX_NAME = 'tile_index.sqlite'
+#每次executemany写入的行数
+BATCH = 1000
+
+class TileIndex(object):
+    def __init__(self, froot):
+        self.path = os.path.join(froot, INDEX_NAME)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                          'z INTEGER, x INTEGER, y INTEGER, size INTEGER, etag TEXT, mtime REAL, '
+                          'PRIMARY KEY (z, x, y))')
+        self.conn.commit()
+
+    def column(self, z, x):
+        '''''一次查询一列的索引，返回{y: size}'''
+        with self.lock:
+            rows = self.conn.execute('SELECT y, size FROM tiles WHERE z=? AND x=?', (z, x)).fetchall()
+        return dict(rows)
+
+    def record(self, rows):
+        '''''rows为(z, x, y, size, etag)，按BATCH分批在事务中写入'''
+        mtime = time.time()
+        with self.lock:
+            for start in range(0, len(rows), BATCH):
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)',
+                                          [row + (mtime,) for row in rows[start:start + BATCH]])
+
+    def forget(self, z, x, ys):
+        '''''删除一列中指定y的记录'''
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM tiles WHERE z=? AND x=? AND y=?', [(z, x, y) for y in ys])
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get(froot):
+    '''''每个下载根目录共用一个索引连接'''
+    with _indexes_lock:
+        if froot not in _indexes:
+            _indexes[froot] = TileIndex(froot)
+        return _indexes[froot]
+
+def parse(file_name):
+    '''''从froot/z/x/y.png中解析出(froot, z, x, y)'''
+    fx, name = os.path.split(file_name)
+    flev, x = os.path.split(fx)
+    froot, z = os.path.split(flev)
+    return froot, int(z), int(x), int(os.path.splitext(name)[0])
+
+def record_files(rows):
+    '''''rows为(file_name, size, etag)，按下载根目录分组写入索引'''
+    groups = {}
+    for file_name, size, etag in rows:
+        froot, z, x, y = parse(file_name)
+        groups.setdefault(froot, []).append((z, x, y, size, etag))
+    for froot in groups:
+        get(froot).record(groups[froot])
@@ -0,0 +1,73 @@
+#-*-coding:utf-8-*-
+#tilepack.py
+#打包模式：一列瓦片写入一个flev/xcol_{x}.bin，避免每个瓦片创建一个小文件
+#文件按slot等分，第n个slot存放y0+n的瓦片：4字节小端长度 + PNG数据，长度为0表示尚未下载
+#旁边的xcol_{x}.json记录{"y0": y0, "count": count, "slot": slot}，瓦片y的偏移为(y - y0) * slot
+
+import json
+import mmap
+import os
+import struct
+
+HEADER = struct.Struct('<I')
+#Windows下需要O_BINARY
+OPEN_FLAGS = os.O_RDWR | getattr(os, 'O_BINARY', 0)
+
+def pack_name(flev, x):
+    return flev + '/xcol_%d.bin' % x
+
+def meta_name(pack_file):
+    return os.path.splitext(pack_file)[0] + '.json'
+
+def create(pack_file, y0, count, slot):
+    '''''创建打包文件，已存在时校验y范围是否一致，不一致抛出ValueError
+
+    文件用ftruncate设为count * slot的稀疏文件，只有写入的瓦片占用磁盘'''
+    meta = {'y0': y0, 'count': count, 'slot': slot}
+    side = meta_name(pack_file)
+    if os.path.exists(side):
+        with open(side) as f:
+            old = json.load(f)
+        if old != meta:
+            raise ValueError('%s已按y0=%d count=%d slot=%d创建' % (pack_file, old['y0'], old['count'], old['slot']))
+        return False
+    fd = os.open(pack_file, OPEN_FLAGS | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, count * slot)
+    finally:
+        os.close(fd)
+    #最后写说明文件，中途失败时下次会重新创建
+    with open(side, 'w') as f:
+        json.dump(meta, f)
+    return True
+
+def done(pack_file, count, slot):
+    '''''读取每个slot的长度头，返回已写入瓦片的slot序号集合'''
+    result = set()
+    with open(pack_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for n in range(count):
+                if HEADER.unpack_from(mm, n * slot)[0]:
+                    result.add(n)
+        finally:
+            mm.close()
+    return result
+
+def write(pack_file, offset, slot, data):
+    '''''只映射瓦片所在的slot并写入，多个worker可以同时写同一个打包文件的不同slot'''
+    if HEADER.size + len(data) > slot:
+        raise ValueError('瓦片%d字节超过slot大小%d' % (len(data), slot))
+    #mmap的偏移必须是ALLOCATIONGRANULARITY的整数倍，从slot之前的对齐位置开始映射
+    start = offset % mmap.ALLOCATIONGRANULARITY
+    fd = os.open(pack_file, OPEN_FLAGS)
+    try:
+        mm = mmap.mmap(fd, start + slot, offset=offset - start)
+        try:
+            mm[start + HEADER.size:start + HEADER.size + len(data)] = data
+            #长度头最后写，读到非0长度时数据一定完整
+            mm[start:start + HEADER.size] = HEADER.pack(len(data))
+        finally:
+            mm.close()
+    finally:
+        os.close(fd)